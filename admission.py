@@ -0,0 +1,152 @@
+import math
+import time
+import asyncio
+from collections import deque
+
+# ──────────────────────────────────────────────────
+#  Admission control / load shedding
+#  Cada rota pública tem um limite de concorrência que se adapta à latência
+#  observada (Stripe, Meta, UTMify). Quando a latência sobe acima da linha de
+#  base o limite encolhe; quando volta ao normal e o limite está sendo usado,
+#  cresce. Requisições acima do limite esperam numa fila com prazo; estourou o
+#  prazo (ou a fila), responde 503 rápido com Retry-After.
+#
+#  Todas as rotas disputam o mesmo recurso: as threads do threadpool onde os
+#  handlers (sync) rodam. O CapacityPool representa esse orçamento global;
+#  cada gate tem um `reserve` de slots do pool que ele NÃO pode usar, que
+#  ficam guardados para as rotas de maior prioridade.
+
+
+class CapacityPool:
+    def __init__(self, capacity):
+        self.capacity  = capacity
+        self.in_flight = 0
+        self.gates     = []   # em ordem de prioridade (registro)
+
+    def dispatch(self):
+        # entrega slots livres para quem está na fila, maior prioridade primeiro
+        for gate in self.gates:
+            while gate.waiters and gate.can_admit():
+                fut = gate.waiters.popleft()
+                if not fut.done():
+                    gate.admit()
+                    fut.set_result(True)
+
+
+class AdmissionGate:
+    def __init__(self, name, pool, initial_limit, min_limit, max_limit,
+                 queue_timeout, max_queue, retry_after, reserve=0):
+        self.name          = name
+        self.pool          = pool
+        self.limit         = float(initial_limit)
+        self.min_limit     = min_limit
+        self.max_limit     = max_limit
+        self.queue_timeout = queue_timeout   # segundos que aceitamos esperar na fila
+        self.max_queue     = max_queue
+        self.retry_after   = retry_after     # piso do Retry-After (segundos)
+        self.reserve       = reserve         # slots do pool reservados p/ maior prioridade
+        self.in_flight     = 0
+        self.waiters       = deque()
+        self.long_rtt      = None            # linha de base (EWMA lenta)
+        self.short_rtt     = None            # latência recente (EWMA rápida)
+        self.samples       = 0
+        pool.gates.append(self)
+
+    def can_admit(self) -> bool:
+        return (self.in_flight < int(self.limit)
+                and self.pool.in_flight < self.pool.capacity - self.reserve)
+
+    def admit(self):
+        self.in_flight      += 1
+        self.pool.in_flight += 1
+
+    def retry_after_seconds(self) -> int:
+        rtt = self.short_rtt or 0.0
+        backlog = (len(self.waiters) + self.in_flight) / max(self.limit, 1.0)
+        return max(self.retry_after, min(60, math.ceil(rtt * backlog)))
+
+    async def acquire(self, budget: float) -> bool:
+        if not self.waiters and self.can_admit():
+            self.admit()
+            return True
+        if budget <= 0 or len(self.waiters) >= self.max_queue:
+            return False
+
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append(fut)
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout=budget)
+            return True
+        except asyncio.TimeoutError:
+            if fut.done() and not fut.cancelled():
+                # o slot chegou junto com o timeout: devolve para o próximo
+                self.release(None)
+            return False
+        except asyncio.CancelledError:
+            # cliente desistiu enquanto esperava
+            if fut.done() and not fut.cancelled():
+                self.release(None)
+            raise
+        finally:
+            if fut in self.waiters:
+                self.waiters.remove(fut)
+
+    def release(self, latency, failed=False):
+        if latency is not None:
+            if failed and self.short_rtt is not None:
+                # erro (timeout, conexão) conta no mínimo como a latência recente,
+                # para que falhas rápidas não façam o limite crescer
+                latency = max(latency, self.short_rtt)
+            self._update_limit(latency)
+        self.in_flight      -= 1
+        self.pool.in_flight -= 1
+        self.pool.dispatch()
+
+    def _update_limit(self, latency: float):
+        # chamado antes de liberar o slot: in_flight ainda inclui esta requisição
+        self.samples += 1
+        if self.long_rtt is None:
+            self.long_rtt = self.short_rtt = latency
+            return
+        # mesma taxa nos dois sentidos: a linha de base é a média de longo prazo,
+        # não o lado rápido da distribuição. No começo as duas são média simples,
+        # para a primeira amostra não virar a linha de base.
+        a_short = max(0.1,  1.0 / self.samples)
+        a_long  = max(0.01, 1.0 / self.samples)
+        self.short_rtt = (1 - a_short) * self.short_rtt + a_short * latency
+        self.long_rtt  = (1 - a_long)  * self.long_rtt  + a_long  * latency
+        if self.samples < 20:
+            return
+
+        # gradiente: base / recente. Com tolerância de 1.5 o jitter normal dá 1;
+        # só encolhe quando a média recente passa 50% acima da base.
+        gradient = max(0.5, min(1.0, 1.5 * self.long_rtt / self.short_rtt))
+        # só mexe num limite que está em uso (metade ou mais ocupada): sem carga
+        # não há o que proteger, e o crescimento fica preso ao uso real
+        if self.in_flight < self.limit / 2:
+            return
+        if gradient >= 1.0:
+            new_limit = self.limit + math.sqrt(self.limit)
+        else:
+            new_limit = self.limit * gradient
+        new_limit = 0.8 * self.limit + 0.2 * new_limit
+        self.limit = max(self.min_limit, min(self.max_limit, new_limit))
+
+
+def queued_for(request) -> float:
+    # Heroku (e outros routers) marcam a chegada em X-Request-Start;
+    # desconta da fila o tempo que a requisição já esperou antes de chegar aqui
+    raw = (request.headers.get("x-request-start") or "").strip()
+    if raw.startswith("t="):
+        raw = raw[2:]
+    try:
+        start = float(raw)
+    except ValueError:
+        return 0.0
+    if not math.isfinite(start) or start <= 0:
+        return 0.0
+    if start > 1e14:    # microssegundos
+        start /= 1e6
+    elif start > 1e11:  # milissegundos
+        start /= 1e3
+    return max(0.0, time.time() - start)
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Depends
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from decimal import Decimal
@@ -13,12 +13,84 @@ import urllib.parse
 import hmac, base64
 import json
 import uuid
+import anyio
+from contextlib import asynccontextmanager
+from admission import CapacityPool, AdmissionGate, queued_for
 
 def add_sid(url: str) -> str:
     sep = '&' if '?' in url else '?'
     return f"{url}{sep}sid={{CHECKOUT_SESSION_ID}}"
 
-app = FastAPI()
+# Threadpool e pool de admissão (abaixo) usam o mesmo tamanho, fixado aqui no
+# startup; senão o `reserve` dos gates deixa de garantir nada.
+THREADPOOL_SIZE = 40
+
+@asynccontextmanager
+async def lifespan(app):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+# ──────────────────────────────────────────────────
+#  Admission control (ver admission.py)
+#  Os handlers são `def` e rodam no threadpool do anyio, assim as chamadas
+#  bloqueantes ao Stripe/Meta/UTMify não travam o event loop e os prazos da
+#  fila / 503 continuam valendo.
+admission_pool = CapacityPool(capacity=THREADPOOL_SIZE)
+
+# ordem de criação = prioridade no pool
+checkout_gate = AdmissionGate("checkout", admission_pool,
+                              initial_limit=10, min_limit=2, max_limit=40,
+                              queue_timeout=8.0, max_queue=200, retry_after=2)
+upsell_gate   = AdmissionGate("upsell", admission_pool,
+                              initial_limit=5, min_limit=1, max_limit=20,
+                              queue_timeout=4.0, max_queue=100, retry_after=2,
+                              reserve=8)
+# Stripe reentrega webhooks: shed agressivo e nunca usa os slots de checkout/upsell
+webhook_gate  = AdmissionGate("webhook", admission_pool,
+                              initial_limit=2, min_limit=1, max_limit=8,
+                              queue_timeout=0.25, max_queue=20, retry_after=10,
+                              reserve=16)
+
+ADMISSION_GATES = {
+    "/create-checkout-session": checkout_gate,
+    "/upsell/intent":           upsell_gate,
+    "/webhook":                 webhook_gate,
+}
+# ──────────────────────────────────────────────────
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    gate = ADMISSION_GATES.get(request.url.path)
+    if gate is None or request.method != "POST":
+        return await call_next(request)
+
+    budget = gate.queue_timeout - queued_for(request)
+    if not await gate.acquire(budget):
+        retry = gate.retry_after_seconds()
+        print(f"→ 503 [{gate.name}] limit={gate.limit:.1f} in_flight={gate.in_flight} "
+              f"queue={len(gate.waiters)} retry_after={retry}s")
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Server busy, please retry"},
+            headers={"Retry-After": str(retry)},
+        )
+
+    started = time.monotonic()
+    failed  = True
+    try:
+        response = await call_next(request)
+        failed = response.status_code >= 500
+        return response
+    finally:
+        latency = time.monotonic() - started
+        # só amostra quem chegou a chamar o Stripe: 4xx de validação e eventos
+        # ignorados respondem em ms e puxariam a linha de base para zero
+        if not getattr(request.state, "upstream", False):
+            latency = None
+        gate.release(latency, failed=failed)
+
 
 # CORS
 origins = origins = [
@@ -42,6 +114,23 @@ PIXEL_ID            = os.getenv("PIXEL_ID")
 ACCESS_TOKEN        = os.getenv("ACCESS_TOKEN")
 UTMIFY_API_URL      = os.getenv("UTMIFY_API_URL")
 UTMIFY_API_KEY      = os.getenv("UTMIFY_API_KEY")
+HTTP_TIMEOUT        = 10  # segundos; dependência travada não pode segurar o slot
+
+# Stripe: timeout curto e 1 retry (o SDK manda idempotency key nos retries).
+# Pior caso ~2 x HTTP_TIMEOUT, abaixo dos 30s do router do Heroku.
+stripe.default_http_client = stripe.RequestsClient(timeout=HTTP_TIMEOUT)
+stripe.max_network_retries = 1
+
+# marca a requisição como "chamou dependência" para o admission control
+def calls_upstream(request: Request):
+    request.state.upstream = True
+
+# corpo lido no event loop; o handler (sync) roda no threadpool
+async def json_body(request: Request) -> dict:
+    return await request.json()
+
+async def raw_body(request: Request) -> bytes:
+    return await request.body()
 
 @app.get("/health")
 async def health():
@@ -52,10 +141,9 @@ async def ping():
     return {"pong": True}
 
 @app.post("/create-checkout-session")
-async def create_checkout_session(request: Request):
+def create_checkout_session(request: Request, body: dict = Depends(json_body)):
     stripe.api_key = STRIPE_SECRET_KEY
 
-    body = await request.json()
     price_id = body.get("price_id")
     quantity = body.get("quantity", 1)
     customer_email = body.get("customer_email")
@@ -71,6 +159,8 @@ async def create_checkout_session(request: Request):
     if not price_id:
         return JSONResponse(status_code=400, content={"error": "price_id is required"})
 
+    calls_upstream(request)
+
     # escolhe a URL de sucesso de acordo com o produto
     if price_id in (
         'price_1S6eVdEn1uVju5MMBIHounGM', #$9 dolares
@@ -122,12 +212,16 @@ async def create_checkout_session(request: Request):
       }]
     }
     # envia e loga o response para debug
-    resp = requests.post(
-      f"https://graph.facebook.com/v14.0/{PIXEL_ID}/events",
-      params={"access_token": ACCESS_TOKEN},
-      json=event_payload
-    )
-    print("→ InitiateCheckout event sent:", resp.status_code, resp.text)
+    try:
+        resp = requests.post(
+          f"https://graph.facebook.com/v14.0/{PIXEL_ID}/events",
+          params={"access_token": ACCESS_TOKEN},
+          json=event_payload,
+          timeout=HTTP_TIMEOUT
+        )
+        print("→ InitiateCheckout event sent:", resp.status_code, resp.text)
+    except Exception as e:
+        print("→ CAPI (InitiateCheckout) erro:", e)
 
     # ──────────────────────────────────────────────────
     #  Envia pedido (order) ao UTMify
@@ -175,15 +269,19 @@ async def create_checkout_session(request: Request):
         "currency":              session.currency.upper()
       }
     }
-    resp_utm = requests.post(
-      UTMIFY_API_URL,
-      headers={
-        "Content-Type": "application/json",
-        "x-api-token":  UTMIFY_API_KEY
-      },
-      json=utmify_order
-    )
-    print("→ Order enviado ao UTMify:", resp_utm.status_code, resp_utm.text)
+    try:
+        resp_utm = requests.post(
+          UTMIFY_API_URL,
+          headers={
+            "Content-Type": "application/json",
+            "x-api-token":  UTMIFY_API_KEY
+          },
+          json=utmify_order,
+          timeout=HTTP_TIMEOUT
+        )
+        print("→ Order enviado ao UTMify:", resp_utm.status_code, resp_utm.text)
+    except Exception as e:
+        print("→ UTMify (order) erro:", e)
     # ──────────────────────────────────────────────────
 
     return {
@@ -192,9 +290,8 @@ async def create_checkout_session(request: Request):
     }
 
 @app.post("/upsell/intent")
-async def create_upsell_intent(request: Request):
+def create_upsell_intent(request: Request, body: dict = Depends(json_body)):
     stripe.api_key = STRIPE_SECRET_KEY
-    body = await request.json()
     sid      = body.get("sid")
     price_id = body.get("price_id")
     quantity = int(body.get("quantity", 1))
@@ -202,6 +299,8 @@ async def create_upsell_intent(request: Request):
     if not sid or not price_id:
         return JSONResponse(status_code=400, content={"error": "sid and price_id are required"})
 
+    calls_upstream(request)
+
     # 1) Recupera a Session anterior e extrai customer + payment_method
     sess = stripe.checkout.Session.retrieve(
         sid,
@@ -260,8 +359,7 @@ async def create_upsell_intent(request: Request):
     return {"client_secret": intent.client_secret, "pm_id": pm_id}
 
 @app.post("/webhook")
-async def stripe_webhook(request: Request):
-    payload = await request.body()
+def stripe_webhook(request: Request, payload: bytes = Depends(raw_body)):
     sig     = request.headers.get("stripe-signature", "")
 
     # 1) Garante que podemos chamar a API do Stripe
@@ -276,6 +374,7 @@ async def stripe_webhook(request: Request):
 
     # 3) Se for checkout.session.completed, processa
     if event["type"] == "checkout.session.completed":
+        calls_upstream(request)
         session = stripe.checkout.Session.retrieve(
             event["data"]["object"]["id"],
             expand=["line_items"]
@@ -469,12 +568,16 @@ async def stripe_webhook(request: Request):
 
         finally:
             # 4) Mesmo se der erro acima, sempre envia o evento Purchase
-            resp = requests.post(
-                f"https://graph.facebook.com/v14.0/{PIXEL_ID}/events",
-                params={"access_token": ACCESS_TOKEN},
-                json=purchase_payload
-            )
-            print("→ Purchase event sent:", resp.status_code, resp.text)
+            try:
+                resp = requests.post(
+                    f"https://graph.facebook.com/v14.0/{PIXEL_ID}/events",
+                    params={"access_token": ACCESS_TOKEN},
+                    json=purchase_payload,
+                    timeout=HTTP_TIMEOUT
+                )
+                print("→ Purchase event sent:", resp.status_code, resp.text)
+            except Exception as e:
+                print("→ CAPI (Purchase) erro:", e)
 
             # 4.1) Atualiza todo o order como "paid" — POST full payload
             total = session.amount_total
@@ -521,18 +624,23 @@ async def stripe_webhook(request: Request):
              }
             }
             
-            resp_utm = requests.post(
-              UTMIFY_API_URL,
-              headers={
-                "Content-Type": "application/json",
-                "x-api-token":  UTMIFY_API_KEY
-              },
-              json=utmify_order_paid
-            )
-            print("→ Pedido atualizado como pago na UTMify:", resp_utm.status_code, resp_utm.text)
+            try:
+                resp_utm = requests.post(
+                  UTMIFY_API_URL,
+                  headers={
+                    "Content-Type": "application/json",
+                    "x-api-token":  UTMIFY_API_KEY
+                  },
+                  json=utmify_order_paid,
+                  timeout=HTTP_TIMEOUT
+                )
+                print("→ Pedido atualizado como pago na UTMify:", resp_utm.status_code, resp_utm.text)
+            except Exception as e:
+                print("→ UTMify (paid) erro:", e)
 
     elif event["type"] == "payment_intent.succeeded":
         # ↳ UPSSELL 1-CLICK (confirmado no front com confirmCardPayment)
+        calls_upstream(request)
         intent_id = event["data"]["object"]["id"]
         intent = stripe.PaymentIntent.retrieve(intent_id, expand=["latest_charge"])
     
@@ -621,7 +729,8 @@ async def stripe_webhook(request: Request):
             requests.post(
                 f"https://graph.facebook.com/v14.0/{PIXEL_ID}/events",
                 params={"access_token": ACCESS_TOKEN},
-                json=purchase_payload
+                json=purchase_payload,
+                timeout=HTTP_TIMEOUT
             )
         except Exception as e:
             print("→ CAPI (upsell) erro:", e)
@@ -670,7 +779,8 @@ async def stripe_webhook(request: Request):
             resp_utm = requests.post(
               UTMIFY_API_URL,
               headers={"Content-Type": "application/json","x-api-token": UTMIFY_API_KEY},
-              json=utmify_order_paid
+              json=utmify_order_paid,
+              timeout=HTTP_TIMEOUT
             )
             print("→ Upsell pago enviado ao UTMify:", resp_utm.status_code, resp_utm.text)
         except Exception as e:
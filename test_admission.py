@@ -0,0 +1,257 @@
+import time
+import random
+import asyncio
+import pytest
+
+from admission import CapacityPool, AdmissionGate, queued_for
+
+
+def make_gate(limit=2, queue_timeout=0.2, max_queue=10, capacity=40, **kw):
+    pool = CapacityPool(capacity=capacity)
+    gate = AdmissionGate("test", pool, initial_limit=limit, min_limit=1,
+                         max_limit=limit * 10, queue_timeout=queue_timeout,
+                         max_queue=max_queue, retry_after=1, **kw)
+    return pool, gate
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+class FakeRequest:
+    def __init__(self, header=None):
+        self.headers = {"x-request-start": header} if header is not None else {}
+
+
+def test_admits_up_to_limit_then_sheds_without_budget():
+    async def run():
+        pool, gate = make_gate(limit=2)
+        assert await gate.acquire(0)
+        assert await gate.acquire(0)
+        assert not await gate.acquire(0)
+        assert gate.in_flight == 2 and pool.in_flight == 2
+    asyncio.run(run())
+
+
+def test_queued_request_times_out():
+    async def run():
+        _, gate = make_gate(limit=1)
+        assert await gate.acquire(0)
+        started = time.monotonic()
+        assert not await gate.acquire(0.05)
+        assert time.monotonic() - started < 0.5
+        assert gate.in_flight == 1
+        assert not gate.waiters
+        assert gate.retry_after_seconds() >= 1
+    asyncio.run(run())
+
+
+def test_queue_full_sheds_immediately():
+    async def run():
+        _, gate = make_gate(limit=1, max_queue=1)
+        assert await gate.acquire(0)
+        waiter = asyncio.ensure_future(gate.acquire(1.0))
+        await asyncio.sleep(0)
+        assert not await gate.acquire(1.0)
+        gate.release(None)
+        assert await waiter
+    asyncio.run(run())
+
+
+def test_release_hands_slot_to_next_waiter_in_order():
+    async def run():
+        _, gate = make_gate(limit=1)
+        assert await gate.acquire(0)
+        order = []
+
+        async def wait(tag):
+            assert await gate.acquire(1.0)
+            order.append(tag)
+
+        tasks = [asyncio.ensure_future(wait(t)) for t in ("a", "b")]
+        await asyncio.sleep(0)
+        gate.release(None)
+        await settle()
+        assert order == ["a"]
+        assert gate.in_flight == 1
+        gate.release(None)
+        await asyncio.gather(*tasks)
+        assert order == ["a", "b"]
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    async def run():
+        pool, gate = make_gate(limit=1)
+        assert await gate.acquire(0)
+        waiter = asyncio.ensure_future(gate.acquire(1.0))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        gate.release(None)
+        assert gate.in_flight == 0 and pool.in_flight == 0
+        assert not gate.waiters
+    asyncio.run(run())
+
+
+def test_cancel_after_handoff_returns_slot():
+    async def run():
+        pool, gate = make_gate(limit=1)
+        assert await gate.acquire(0)
+        waiter = asyncio.ensure_future(gate.acquire(1.0))
+        await asyncio.sleep(0)
+        gate.release(None)      # slot entregue ao waiter...
+        waiter.cancel()         # ...que é cancelado antes de rodar
+        try:
+            admitted = await waiter
+        except asyncio.CancelledError:
+            admitted = False
+        # ou o waiter ficou com o slot, ou ele foi devolvido: nunca vaza
+        assert gate.in_flight == pool.in_flight == (1 if admitted else 0)
+    asyncio.run(run())
+
+
+def test_reserve_keeps_pool_slots_for_higher_priority():
+    async def run():
+        pool = CapacityPool(capacity=3)
+        high = AdmissionGate("high", pool, initial_limit=3, min_limit=1, max_limit=3,
+                             queue_timeout=1.0, max_queue=10, retry_after=1)
+        low = AdmissionGate("low", pool, initial_limit=3, min_limit=1, max_limit=3,
+                            queue_timeout=0.05, max_queue=10, retry_after=1, reserve=2)
+        assert await low.acquire(0)
+        assert not await low.acquire(0)
+        assert await high.acquire(0)
+        assert await high.acquire(0)
+        # pool cheio: o próximo slot liberado vai para a fila de maior prioridade
+        high_waiter = asyncio.ensure_future(high.acquire(1.0))
+        await asyncio.sleep(0)
+        low.release(None)
+        assert await high_waiter
+        assert high.in_flight == 3 and low.in_flight == 0
+    asyncio.run(run())
+
+
+
+
+def drive(gate, latencies, load):
+    # mantém `load` (fração do limite) requisições em voo e libera uma por amostra
+    for latency in latencies:
+        target = max(1, int(gate.limit * load))
+        while gate.in_flight < target and gate.can_admit():
+            gate.admit()
+        gate.release(latency)
+
+
+def checkout_like_gate():
+    pool = CapacityPool(capacity=40)
+    return AdmissionGate("checkout", pool, initial_limit=10, min_limit=2, max_limit=40,
+                         queue_timeout=8.0, max_queue=200, retry_after=2)
+
+
+@pytest.mark.parametrize("sigma", [0.3, 0.5, 0.8])
+@pytest.mark.parametrize("load", [0.0, 0.6, 1.0])
+def test_limit_holds_under_jittered_steady_latency(sigma, load):
+    rnd = random.Random(1)
+    gate = checkout_like_gate()
+    drive(gate, [rnd.lognormvariate(0, sigma) for _ in range(3000)], load)
+    assert gate.limit >= 9
+
+
+def test_limit_holds_with_mix_of_fast_and_slow_responses():
+    rnd = random.Random(2)
+    gate = checkout_like_gate()
+    latencies = [0.02 if rnd.random() < 0.3 else rnd.lognormvariate(0, 0.4)
+                 for _ in range(3000)]
+    drive(gate, latencies, 1.0)
+    assert gate.limit >= 9
+
+
+def test_limit_shrinks_on_sustained_rise_under_load_and_recovers():
+    rnd = random.Random(3)
+    gate = checkout_like_gate()
+    drive(gate, [rnd.lognormvariate(0, 0.4) for _ in range(300)], 1.0)
+    healthy = gate.limit
+    drive(gate, [5 * rnd.lognormvariate(0, 0.4) for _ in range(50)], 1.0)
+    assert gate.limit < healthy / 3
+    drive(gate, [rnd.lognormvariate(0, 0.4) for _ in range(200)], 1.0)
+    assert gate.limit >= healthy / 2
+
+
+def test_limit_shrinks_when_latency_rises():
+    _, gate = make_gate(limit=10, capacity=1000)
+    drive(gate, [0.5] * 150, 1.0)
+    before = gate.limit
+    drive(gate, [5.0] * 10, 1.0)
+    assert gate.limit < before / 2
+    # a linha de base não corre atrás da latência degradada
+    assert gate.long_rtt < 1.5
+
+
+def test_unused_limit_is_left_alone():
+    _, gate = make_gate(limit=10)
+    drive(gate, [0.5] * 150 + [5.0] * 50, 0.0)
+    assert gate.limit == 10
+
+
+def test_limit_does_not_grow_when_not_binding():
+    async def run():
+        _, gate = make_gate(limit=10)
+        for _ in range(50):
+            assert await gate.acquire(0)
+            gate.release(0.1)
+        assert gate.limit == 10
+    asyncio.run(run())
+
+
+def test_failures_count_as_at_least_recent_latency():
+    async def run():
+        _, gate = make_gate(limit=4)
+        for _ in range(5):
+            assert await gate.acquire(0)
+            gate.release(1.0)
+        assert await gate.acquire(0)
+        gate.release(0.001, failed=True)
+        assert gate.short_rtt == pytest.approx(1.0)
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("fmt", [
+    lambda t: f"t={int(t * 1e6)}",
+    lambda t: f"{t:.3f}",
+    lambda t: str(int(t * 1e3)),
+    lambda t: str(int(t * 1e6)),
+])
+def test_queued_for_units(fmt):
+    assert queued_for(FakeRequest(fmt(time.time() - 2))) == pytest.approx(2, abs=0.1)
+
+
+@pytest.mark.parametrize("header", [None, "", "garbage", "t=", "nan", "inf", "-5"])
+def test_queued_for_garbage(header):
+    assert queued_for(FakeRequest(header)) == 0.0
+
+
+def test_queued_for_future_timestamp_is_zero():
+    assert queued_for(FakeRequest(str(int((time.time() + 60) * 1e3)))) == 0.0
+
+
+def test_deadline_holds_while_handlers_block_in_threads():
+    # handlers sync rodam fora do loop (threadpool): o prazo da fila vale
+    async def run():
+        _, gate = make_gate(limit=2)
+
+        async def handler():
+            if not await gate.acquire(0.3):
+                return "503"
+            await asyncio.to_thread(time.sleep, 1.0)
+            gate.release(1.0)
+            return "ok"
+
+        started = time.monotonic()
+        first = [asyncio.ensure_future(handler()) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        assert await handler() == "503"
+        assert time.monotonic() - started < 0.6
+        assert await asyncio.gather(*first) == ["ok", "ok"]
+    asyncio.run(run())
@@ -0,0 +1,91 @@
+import asyncio
+from types import SimpleNamespace
+from unittest import mock
+
+import anyio
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def fresh_gates(monkeypatch):
+    for gate in main.ADMISSION_GATES.values():
+        monkeypatch.setattr(gate, "long_rtt", None)
+        monkeypatch.setattr(gate, "short_rtt", None)
+        monkeypatch.setattr(gate, "samples", 0)
+    yield
+    for gate in main.ADMISSION_GATES.values():
+        assert gate.in_flight == 0
+    assert main.admission_pool.in_flight == 0
+
+
+@pytest.fixture
+def client():
+    with TestClient(main.app, raise_server_exceptions=False) as c:
+        yield c
+
+
+def fake_session():
+    price = SimpleNamespace(id="price_x", nickname="")
+    item = SimpleNamespace(price=price, description="Item", quantity=1, amount_subtotal=900)
+    return SimpleNamespace(
+        id="cs_test", url="https://checkout", currency="usd", amount_total=900,
+        line_items=SimpleNamespace(data=[item]), customer_details=None,
+        metadata={},
+    )
+
+
+def test_overloaded_route_gets_503_with_retry_after(client, monkeypatch):
+    monkeypatch.setattr(main.checkout_gate, "limit", 0)
+    monkeypatch.setattr(main.checkout_gate, "queue_timeout", 0)
+    resp = client.post("/create-checkout-session", json={"price_id": "price_x"})
+    assert resp.status_code == 503
+    assert resp.json() == {"error": "Server busy, please retry"}
+    assert int(resp.headers["retry-after"]) >= main.checkout_gate.retry_after
+
+
+def test_non_post_bypasses_gate(client, monkeypatch):
+    monkeypatch.setattr(main.checkout_gate, "limit", 0)
+    monkeypatch.setattr(main.checkout_gate, "queue_timeout", 0)
+    assert client.get("/create-checkout-session").status_code == 405
+    assert client.get("/health").status_code == 200
+
+
+def test_fast_4xx_is_not_a_latency_sample(client):
+    resp = client.post("/create-checkout-session", json={})
+    assert resp.status_code == 400
+    assert main.checkout_gate.long_rtt is None
+
+
+def test_successful_checkout_feeds_limit(client):
+    with mock.patch.object(main.stripe.checkout.Session, "create", return_value=fake_session()), \
+         mock.patch.object(main.requests, "post") as post:
+        resp = client.post("/create-checkout-session", json={"price_id": "price_x"})
+    assert resp.status_code == 200
+    assert resp.json()["session_id"] == "cs_test"
+    assert post.call_count == 2
+    assert all(c.kwargs["timeout"] == main.HTTP_TIMEOUT for c in post.call_args_list)
+    assert main.checkout_gate.long_rtt is not None
+
+
+def test_slot_released_when_handler_raises(client):
+    with mock.patch.object(main.stripe.checkout.Session, "create",
+                           side_effect=RuntimeError("stripe down")):
+        resp = client.post("/create-checkout-session", json={"price_id": "price_x"})
+    assert resp.status_code == 500
+    # chamou o Stripe: o erro conta como amostra de latência
+    assert main.checkout_gate.long_rtt is not None
+
+
+def test_stripe_client_is_bounded():
+    assert main.stripe.default_http_client._timeout == main.HTTP_TIMEOUT
+    assert main.stripe.max_network_retries == 1
+
+
+def test_startup_sizes_threadpool_to_admission_pool():
+    async def run():
+        async with main.lifespan(main.app):
+            return anyio.to_thread.current_default_thread_limiter().total_tokens
+    assert asyncio.run(run()) == main.THREADPOOL_SIZE == main.admission_pool.capacity